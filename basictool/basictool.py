@@ -55,6 +55,9 @@ import os
 # Import the object-oriented filesystem paths "pathlib"
 import pathlib
 
+# Pack fixed-layout binary records.
+import struct
+
 # ---------------------------------------------------------------------------------------
 # END Import modules and dependencies
 # ---------------------------------------------------------------------------------------
@@ -64,97 +67,149 @@ import pathlib
 # BEGIN Class Declarations
 # ---------------------------------------------------------------------------------------
 
+# Finds the first byte with bit 7 set, which terminates an identifier name.
+_HIGH_BIT = re.compile(rb"[\x80-\xff]")
+
+# Matches a run of base 64 constant digits ($40-$7F).
+_BASE64_RUN = re.compile(rb"[\x40-\x7f]*")
+
+# Character class used to decide spacing in listings, indexed by character code:
+# ' ' for space, 'I' for identifier characters, 'N' for anything else.
+def _classify(c):
+    c = c.upper()
+    if c != ' ':
+        c = 'I' if (c >= '0' and c <= '9') or (c >= 'A' and c <= 'Z') or c == '_' else 'N'
+    return c
+
+_TYPE_TABLE = "".join(_classify(chr(i)) for i in range(256))
+
+# Decimal digit pairs packed in BCD, indexed by byte; a nibble of $F is padding.
+_BCD_TABLE = ["{0}{1}".format("" if (d & 240) == 240 else d >> 4,"" if (d & 15) == 15 else (d & 15)) for d in range(256)]
+
+# Tokeniser patterns, each consuming trailing whitespace.
+_NUM_RE = re.compile("(\\d+)\\s*")
+_DEC_RE = re.compile("\\.(\\d+)\\s*")
+_HEX_RE = re.compile("\\$([0-9A-Fa-f]+)\\s*")
+_STR_RE = re.compile('\\"(.*?)\\"\\s*')
+_IDENT_RE = re.compile("([A-Za-z0-9\\_\\.]+\\$?\\(?)\\s*")
+
+# Identifiers eligible for #define substitution.
+_IDENT_SPLIT = re.compile("[A-Za-z][A-Za-z0-9\\._]*")
+
 # CLASS (Detokenizer): Program Listing Class
 # ---------------------------------------------------------------------------------------
 class ProgramLister:
     def __init__(self,fileName,showLineNumbers):
-        self.bin = bytearray(open(fileName,"rb").read(-1))
-        self.ts = TokenSet()
+        with open(fileName,"rb") as f:
+            self.bin = f.read()
+        self.ts = _TOKENS
         self.dollar = self.ts.getByName("$").getID()
+        self.id_end = self.ts.getByName("!!END").getID()
+        self.id_str = self.ts.getByName("!!STR").getID()
+        self.id_dec = self.ts.getByName("!!DEC").getID()
+        self.id_sh1 = self.ts.getByName("!!SH1").getID()
+        self.id_sh2 = self.ts.getByName("!!SH2").getID()
         self.showLineNumbers = showLineNumbers
-        self.code_listing = str()
+        self._parts = []
+        #
+        #        Handler for each possible leading byte of an element.
+        #
+        self._dispatch = [self.listUnknown] * 256
+        for n in range(0x00,0x20):
+            self._dispatch[n] = self.listIdentifier
+        for n in list(range(0x20,0x40)) + list(range(0x80,0x100)):
+            self._dispatch[n] = self.listToken
+        for n in range(0x40,0x80):
+            self._dispatch[n] = self.listNumber
+        self._dispatch[self.id_str] = self.listString
+        self._dispatch[self.id_dec] = self.listDecimal
+        self._dispatch[self.dollar] = self.listHex
+
+    @property
+    def code_listing(self):
+        return "".join(self._parts)
 
     def list_code(self):
-        code = self.bin[0] << 8
-        while self.bin[code] != 0:
-            self.listLine(code)
-            code += self.bin[code]
+        listLine = self.listLine
+        for lineStart in self.lineStarts():
+            listLine(lineStart)
+
+    def lineStarts(self):
+        data = self.bin
+        starts = []
+        code = data[0] << 8
+        size = data[code]
+        while size != 0:
+            starts.append(code)
+            code += size
+            size = data[code]
+        return starts
 
     def listLine(self,lineStart):
-        self.text = "{0} ".format(self.bin[lineStart+1]+self.bin[lineStart+2] * 256) if self.showLineNumbers else ""
+        self._text_parts = ["{0} ".format(self.bin[lineStart+1]+self.bin[lineStart+2] * 256)] if self.showLineNumbers else []
         p = lineStart + 3
-        while self.bin[p] != self.ts.getByName("!!END").getID():
-            p = self.listOneElement(p)
+        data,end,dispatch = self.bin,self.id_end,self._dispatch
+        while data[p] != end:
+            p = dispatch[data[p]](p)
+        self.text = "".join(self._text_parts)
         # print(self.text)
-        self.code_listing += self.text + "\n"
-
-    def listOneElement(self,p):
-        n = self.bin[p]
+        self._parts.append(self.text + "\n")
+
+    def listIdentifier(self,p):
+        va = (self.bin[p] << 8)+self.bin[p+1]+5
+        ve = _HIGH_BIT.search(self.bin,va).start()
+        name = self.bin[va:ve].decode("latin1") + chr(self.bin[ve] & 0x7F)
+        self.append(name.lower())
+        return p+2
+
+    def listString(self,p):
+        size = self.bin[p+1]
+        self.append('"'+self.bin[p+2:p+2+size].decode("latin1")+'"')
+        return p + size + 2
+
+    def listDecimal(self,p):
+        size = self.bin[p+1]
+        self.append('.'+"".join([_BCD_TABLE[d] for d in self.bin[p+2:p+2+size]]))
+        return p + size + 2
+
+    def listNumber(self,p):
+        v,p = self.decodeConstant(p)
+        self.append(str(v))
+        return p
 
-        if n >= 0x00 and n < 0x20:
-            va = (n << 8)+self.bin[p+1]+5
-            p += 2
-            name = ""
-            while self.bin[va] < 0x80:
-                name += chr(self.bin[va])
-                va += 1
-            name += chr(self.bin[va] & 0x7F)
-            self.append(name.lower())
-
-        elif n == self.ts.getByName("!!STR").getID():
-            self.append('"'+"".join([chr(self.bin[p+2+c]) for c in range(0,self.bin[p+1])])+'"')
-            p = p + self.bin[p+1] + 2
-
-        elif n == self.ts.getByName("!!DEC").getID():
-            self.append('.'+"".join([self.decode(self.bin[p+2+c]) for c in range(0,self.bin[p+1])]))
-            p = p + self.bin[p+1] + 2
-
-        elif n >= 0x40 and n < 0x80:
-            v = 0
-            while self.bin[p] >= 0x40 and self.bin[p] < 0x80:
-                v = (v << 6) + self.bin[p] - 0x40
-                p += 1
-            self.append(str(v))
-
-        elif n == self.dollar:
-            self.append(" $")
-            p += 1
-            v = 0
-            while self.bin[p] >= 0x40 and self.bin[p] < 0x80:
-                v = (v << 6) + self.bin[p] - 0x40
-                p += 1
-            self.append("{0:x}".format(v))
+    def listHex(self,p):
+        self.append(" $")
+        v,p = self.decodeConstant(p+1)
+        self.append("{0:x}".format(v))
+        return p
 
-        elif n >= 0x80 or (n >= 0x20 and n < 0x40):
+    def listToken(self,p):
+        n = self.bin[p]
+        p += 1
+        if n == self.id_sh1:
+            n = self.bin[p] + 0x100
             p += 1
-            if n == self.ts.getByName("!!SH1").getID():
-                n = self.bin[p] + 0x100
-                p += 1
-            if n == self.ts.getByName("!!SH2").getID():
-                n = self.bin[p] + 0x200
-                p += 1
-            s = self.ts.getByID(n).getName()
-            self.append(s)
-
-        else:
-            self.text += "[{0:02x}]".format(self.bin[p])
+        elif n == self.id_sh2:
+            n = self.bin[p] + 0x200
             p += 1
-
+        self.append(self.ts.idToToken[n].getName())
         return p
 
-    def append(self,s):
-        if self.text != "" and self.type(self.text[-1]) == self.type(s[0]):
-            self.text += " "
-        self.text += s
+    def listUnknown(self,p):
+        self._text_parts.append("[{0:02x}]".format(self.bin[p]))
+        return p+1
 
-    def type(self,c):
-        c = c.upper()
-        if c != ' ':
-            c = 'I' if (c >= '0' and c <= '9') or (c >= 'A' and c <= 'Z') or c == '_' else 'N'
-        return c
+    def append(self,s):
+        if self._text_parts and _TYPE_TABLE[ord(self._text_parts[-1][-1])] == _TYPE_TABLE[ord(s[0])]:
+            self._text_parts.append(" ")
+        self._text_parts.append(s)
 
-    def decode(self,d):
-        return "{0}{1}".format("" if (d & 240) == 240 else d >> 4,"" if (d & 15) == 15 else (d & 15))
+    def decodeConstant(self,p):
+        run = _BASE64_RUN.match(self.bin,p).group(0)
+        v = 0
+        for b in run:
+            v = (v << 6) | (b & 0x3F)
+        return v,p+len(run)
 
 
 # CLASS (Detokenizer): Class representing an individual token
@@ -213,6 +268,7 @@ class TokenSet(object):
 
     def addToken(self,tokenID,tokenText):
         tokenText = tokenText.strip().lower()
+        assert not self.frozen,"TokenSet is read-only once created"
         assert tokenID not in self.idToToken,"Duplicate "+tokenText
         if tokenText != "":
             assert tokenText not in self.nameToToken,"Duplicate "+tokenText
@@ -221,6 +277,7 @@ class TokenSet(object):
         self.nameToToken[token.getName()] = token
 
     def create(self):
+        self.frozen = False
         self.nextToken = None
         self.idToToken = {}
         self.nameToToken = {}
@@ -295,6 +352,11 @@ class TokenSet(object):
             IDEVICE( SPC(     TAB(     UHASDATA( MOS(     HAVEMOUSE( LOWER$( POW(
             EXISTS(
         """)
+        self.frozen = True
+
+
+# The token table is fixed, so a single instance is shared by every class that needs it.
+_TOKENS = TokenSet()
 
 
 # CLASS (Tokenizer):  Identifier storage class
@@ -302,15 +364,12 @@ class TokenSet(object):
 
 class IdentifierStore(object):
 	def __init__(self):
-		self.store = [ 0x1 ] 																# one page.
+		self.store = bytearray(b"\x01") 													# one page.
 		self.identifiers = {}
 	#
 	def render(self):
 		reqLength = self.store[0] * 256  													# Actual size
-		render = [x for x in self.store] 													# make a copy
-		while len(render) < reqLength:  													# Pad out with zeor.
-			render.append(0)
-		return render
+		return bytes(self.store).ljust(reqLength,b"\x00") 									# Copy, padded out with zero.
 	#
 	def get(self,name):
 		name = name.upper()
@@ -323,14 +382,11 @@ class IdentifierStore(object):
 		self.identifiers[name] = len(self.store)+1 											# Points to data, offset 1 in record.
 		isString = name.endswith("$") or name.endswith("$(") 								# Work out type byte
 		isArray = name.endswith("(")
-		self.store.append(len(name)+6)														# Offset byte
-		self.store += [0,0,0,0] 															# default value
 		ctrl = 0x80 if isString else 0x00
 		ctrl = ctrl + 0x10 if isArray else ctrl
-		self.store.append(ctrl) 															# control byte.
-		b = [ord(x) for x in name] 															# work out name
-		b[-1] |= 0x80
-		self.store += b																		# name
+		self.store.extend(struct.pack("<BIB",len(name)+6,0,ctrl)) 							# Offset byte, default value, control byte.
+		self.store.extend(name.encode("ascii")) 											# name
+		self.store[-1] |= 0x80
 		aAddress = len(self.store)
 		if (bAddress & 0x80) == 0 and (aAddress & 0x80) != 0:  								# creating crossed the middle of the page
 			self.store[0] += 1 																# Another page.
@@ -356,106 +412,113 @@ class IdentifierStore(object):
 # ---------------------------------------------------------------------------------------
 class Tokeniser(object):
 	def __init__(self,identStore):
-		self.ts = TokenSet()
+		self.ts = _TOKENS
 		self.iStore = identStore
+		self._punct2 = frozenset(name for name in self.ts.nameToToken if len(name) == 2 and not name[0].isalnum())
+		self._punct1 = frozenset(name for name in self.ts.nameToToken if len(name) == 1)
+		self._get = self.ts.nameToToken.__getitem__
+		self._identCache = {}
+		self._dispatch = { '$':self.tokeniseHex,'"':self.tokeniseString,"'":self.tokeniseComment }
+		for c in "0123456789":
+			self._dispatch[c] = self.tokeniseNumber
+		for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+			self._dispatch[c] = self.tokeniseIdentifier
+			self._dispatch[c.lower()] = self.tokeniseIdentifier
 	#
 	def tokenise(self,s):
 		s = s.strip()
-		self.code = []
+		self.code = bytearray()
+		dispatch,punctuation = self._dispatch,self.tokenisePunctuation
 		while s != "" and not s.startswith("//"):
-			s = self.tokeniseOne(s).strip()
+			s = dispatch.get(s[0],punctuation)(s).strip()
 		return self.code
 	#
-	def tokeniseOne(self,s):
-		#
-		#		Numbers, compiled in base 64
-		#
-		if s[0] >= "0" and s[0] <= "9":
-			m = re.match("(\\d+)\\s*(.*)$",s)
-			self.renderConstant(int(m.group(1)))
-			s = m.group(2)
-			m = re.match('\\.(\\d+)\\s*(.*)',s)
-			if m is not None:
-				digits = ([int(x) for x in m.group(1)] + [0xF])
-				digits = digits if len(digits) % 2 == 0 else digits + [0xF]
-				self.code.append(self.getTokenID("!!dec"))
-				self.code.append(len(digits) >> 1)
-				while len(digits) > 0:
-					self.code.append(digits[0]*16+digits[1])
-					digits = digits[2:]
-				return m.group(2)
-			return s
-		#
-		#		Hexadecimal numbers also in base 64
-		#
-		if s[0] == '$':
-			m = re.match("\\$([0-9A-Fa-f]+)\\s*(.*)$",s)
-			self.code.append(self.getTokenID("$"))
-			self.renderConstant(int(m.group(1),16))
-			return m.group(2)
-		#
-		#		Quoted string : [!!str] [length] [characters]
-		#
-		if s[0] == '"':
-			m = re.match('\\"(.*?)\\"\\s*(.*)',s)
-			self.code.append(self.getTokenID("!!str"))
-			self.code.append(len(m.group(1)))
-			self.code += [ord(c) for c in m.group(1)]
-			return m.group(2)
+	#		Numbers, compiled in base 64
+	#
+	def tokeniseNumber(self,s):
+		m = _NUM_RE.match(s)
+		self.renderConstant(int(m.group(1)))
+		s = s[m.end():]
 		#
 		#		Decimals [!!dec] [length] [digits packed in BCD, ending in $F, max of 8 digits]
 		#
-		#
-		#		Comment
-		#
-		if s[0] == "'":
-			s = s[1:].strip()
-			self.code.append(self.getTokenID("'"))
-			if s != "":
-				s = s.replace('"','')
-				self.code.append(self.getTokenID("!!str"))
-				self.code.append(len(s))
-				self.code += [ord(c) for c in s]
-			return ""
-		#
-		#		Identifier or Token
-		#
-		if s[0].upper() >= "A" and s[0].upper() <= "Z":
-			m = re.match("^([A-Za-z0-9\\_\\.]+\\$?\\(?)\\s*(.*)$",s)
-			t = self.ts.getByName(m.group(1))
+		m = _DEC_RE.match(s)
+		if m is not None:
+			digits = ([int(x) for x in m.group(1)] + [0xF])
+			digits = digits if len(digits) % 2 == 0 else digits + [0xF]
+			self.code.append(self.getTokenID("!!dec"))
+			self.code.append(len(digits) >> 1)
+			while len(digits) > 0:
+				self.code.append(digits[0]*16+digits[1])
+				digits = digits[2:]
+			return s[m.end():]
+		return s
+	#
+	#		Hexadecimal numbers also in base 64
+	#
+	def tokeniseHex(self,s):
+		m = _HEX_RE.match(s)
+		self.code.append(self.getTokenID("$"))
+		self.renderConstant(int(m.group(1),16))
+		return s[m.end():]
+	#
+	#		Quoted string : [!!str] [length] [characters]
+	#
+	def tokeniseString(self,s):
+		m = _STR_RE.match(s)
+		self.code.append(self.getTokenID("!!str"))
+		self.code.append(len(m.group(1)))
+		self.code.extend(m.group(1).encode("latin1"))
+		return s[m.end():]
+	#
+	#		Comment
+	#
+	def tokeniseComment(self,s):
+		s = s[1:].strip()
+		self.code.append(self.getTokenID("'"))
+		if s != "":
+			s = s.replace('"','')
+			self.code.append(self.getTokenID("!!str"))
+			self.code.append(len(s))
+			self.code.extend(s.encode("latin1"))
+		return ""
+	#
+	#		Identifier or Token
+	#
+	def tokeniseIdentifier(self,s):
+		m = _IDENT_RE.match(s)
+		name = m.group(1)
+		code = self._identCache.get(name)
+		if code is None:
+			t = self.ts.getByName(name)
 			if t is not None:
 				id = t.getID()
-				if id >= 0x100:
-					self.code.append(self.getTokenID("!!sh"+str(id >> 8)))
-				self.code.append(id & 0xFF)
+				code = bytes([self.getTokenID("!!sh"+str(id >> 8)),id & 0xFF]) if id >= 0x100 else bytes([id])
 			else:
-				if self.iStore.get(m.group(1)) is None:
-					self.iStore.add(m.group(1))
-				id = self.iStore.get(m.group(1))
-				self.code.append(id >> 8)
-				self.code.append(id & 0xFF)
-			return m.group(2)
-		#
-		#		Punctuation
-		#
-		if len(s) >= 2:
-			id = self.ts.getByName(s[:2])
-			if id is not None:
-				self.code.append(id.getID())
-				return s[2:]
+				if self.iStore.get(name) is None:
+					self.iStore.add(name)
+				id = self.iStore.get(name)
+				code = bytes([id >> 8,id & 0xFF])
+			self._identCache[name] = code 												# identifier addresses never move once added.
+		self.code.extend(code)
+		return s[m.end():]
+	#
+	#		Punctuation
+	#
+	def tokenisePunctuation(self,s):
+		if s[:2] in self._punct2:
+			self.code.append(self._get(s[:2]).getID())
+			return s[2:]
 		#
-		id = self.ts.getByName(s[0])
-		assert id is not None
-		self.code.append(id.getID())
+		assert s[0] in self._punct1
+		self.code.append(self._get(s[0]).getID())
 		return s[1:]
 	#
 	def getTokenID(self,name):
 		return self.ts.getByName(name).getID()
 	#
 	def renderConstant(self,n):
-		if n >= 64:
-			self.renderConstant(n >> 6)
-		self.code.append(0x40|(n & 0x3F))
+		self.code.extend(encode_constant(n))
 	#
 	def test(self,s):
 		code = self.tokenise(s)
@@ -469,14 +532,15 @@ class Program:
 	def __init__(self):
 		self.nextLine = 100
 		self.lineStep = 10
-		self.code = []
+		self.code = bytearray()
 		self.store = IdentifierStore()
 		self.store.add("A")
 		self.store.add("O")
 		self.store.add("P")
 		self.store.add("X")
 		self.store.add("Y")
-		self.ts = TokenSet()
+		self.ts = _TOKENS
+		self.id_end = self.ts.getByName("!!end").getID()
 		self.tw = Tokeniser(self.store)
 		self.identifiers = {}
 		self.libraryMode = False
@@ -484,12 +548,13 @@ class Program:
 	#		Add the contents of the file, stripping // comments
 	#
 	def addFile(self,fileName):
-		for s in open(fileName).readlines():
+		with open(fileName,encoding="utf-8",buffering=1 << 20) as h:
+			lines = h.read().split("\n")
+		for s in lines:
 			s = s.strip()
 			if s.startswith("#"):
 				self.command(s[1:])
-				s = ""
-			s = s.strip()
+				continue
 			s = self.processIdentifiers(s)
 			if s != "":
 				number = None
@@ -518,11 +583,9 @@ class Program:
 	#		Process identifiers, making define substitutions.
 	#
 	def processIdentifiers(self,s):
-		src = re.split("([A-Za-z][A-Za-z0-9\\._]*)",s)
-		for i in range(0,len(src)):
-			if src[i] in self.identifiers:
-				src[i] = self.identifiers[src[i]]
-		return "".join(src)
+		if not self.identifiers:
+			return s
+		return _IDENT_SPLIT.sub(lambda m: self.identifiers.get(m.group(0),m.group(0)),s)
 	#
 	#		Add a line with an optional line number
 	#
@@ -532,12 +595,12 @@ class Program:
 				self.nextLine = number
 			lineNo = 0 if self.libraryMode else self.nextLine
 			#print(lineNo,text)
-			line = [0,lineNo & 0xFF,lineNo >> 8]
-			line += self.tw.tokenise(text)
-			line.append(self.ts.getByName("!!end").getID())
-			line[0] = len(line)
-			#print(line)
-			self.code += line
+			start = len(self.code)
+			self.code.extend((0,lineNo & 0xFF,lineNo >> 8))
+			self.code.extend(self.tw.tokenise(text))
+			self.code.append(self.id_end)
+			self.code[start] = len(self.code) - start
+			#print(self.code[start:])
 			self.nextLine += self.lineStep
 
 		return self
@@ -554,9 +617,8 @@ class Program:
 	#		Save the resulting tokenised code.
 	#
 	def render(self,fileName):
-		h = open(fileName,"wb")
-		h.write(bytes(self.store.render()+self.code+[0]))
-		h.close()
+		with open(fileName,"wb") as h:
+			h.write(self.store.render()+bytes(self.code)+b"\x00")
 
 
 # ---------------------------------------------------------------------------------------
@@ -569,6 +631,19 @@ class Program:
 # BEGIN Functions Declarations
 # ---------------------------------------------------------------------------------------
 
+# Encode a constant as base 64 digits ($40-$7F), most significant first.
+def encode_constant(n):
+    if n < 0x40:
+        return bytes((0x40|n,))
+    if n < 0x1000:
+        return bytes((0x40|(n >> 6),0x40|(n & 0x3F)))
+    digits = bytearray()
+    while n != 0:
+        digits.append(0x40|(n & 0x3F))
+        n >>= 6
+    digits.reverse()
+    return bytes(digits)
+
 def process_parameters():
     scriptDesc = ("This tool provides the ability to tokenize a basic code (usually *.bsc) text file"
                   " or detokenize *.bas (basic tokenized) binary file." )
@@ -729,7 +804,7 @@ if __name__ == "__main__":
 
         if not input_file:
             console_input = sys.stdin.read()
-            with open("temp.txt", mode='w') as file_handle:
+            with open("temp.txt", mode='w', encoding='utf-8') as file_handle:
                 file_handle.write(console_input)
             tokenize_program.addFile("temp.txt")
             tokenize_program.render(output_file)